@@ -7,13 +7,25 @@ Title:              mac_blocker.py
 Description:        Find and block unauthorized clients from FHI-360 Meraki networks
 Author:             Ricky Laney
 '''
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import csv
 from datetime import datetime
+import functools
+import gzip
+import io
+import itertools
 import os
 import re
+import shutil
 import time
 import meraki
-from typing import Tuple, Union
+from typing import Callable, Tuple, Union
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 import smtplib
 from email.message import EmailMessage
@@ -46,6 +58,36 @@ BLOCK_BAD_CLIENTS = False
 # Catch errors and continue processing
 CATCH_ERRORS = True
 
+# Maximum age in seconds of the manuf database before it is downloaded again
+MANUF_MAX_AGE = 60 * 60 * 24
+
+# Also write a separate report per network next to the consolidated one
+WRITE_NETWORK_REPORTS = True
+
+# Number of networks to fetch clients for at the same time. This caps
+# concurrent requests, not the request rate: paged fetches can still go over
+# the Meraki limit of 10 requests per second per org, and the SDK absorbs the
+# resulting 429s by waiting for their Retry-After (wait_on_rate_limit)
+MAX_WORKERS = 8
+
+# Clients returned per getNetworkClients page, the API maximum
+CLIENTS_PER_PAGE = 5000
+
+# Buffer size for CSV reports so rows are written in large blocks
+CSV_BUFFER_SIZE = 1 << 20
+
+# Client columns of the consolidated report, after the network name and id
+CLIENT_FIELD_NAMES = (
+    'id', 'mac', 'description', 'ip', 'ip6', 'ip6Local', 'user',
+    'firstSeen', 'lastSeen', 'manufacturer', 'os',
+    'recentDeviceSerial', 'recentDeviceName', 'recentDeviceMac', 'recentDeviceConnection',
+    'ssid', 'vlan', 'switchport', 'usage', 'status', 'notes', 'pskGroup', 'namedVlan',
+    'smInstalled', 'groupPolicy8021x', 'adaptivePolicyGroup', 'blocked', 'deviceTypePrediction', 'wirelessCapabilities',
+)
+
+# Characters stripped from MAC addresses before comparing prefixes
+MAC_SEPARATORS = str.maketrans('', '', ':-.')
+
 HERE = os.path.dirname(os.path.abspath(__file__))
 base_url = 'https://api.meraki.com/api/v1'
 
@@ -69,50 +111,145 @@ class ClientValidator:
 
         if self._use_manuf:
             from manuf.manuf import MacParser
-            try:
-                mac_parser = MacParser()
-                mac_parser.update(manuf_url="https://www.wireshark.org/download/automated/data/manuf")
-            except Exception as e:
-                verboseprint(f"Unable to update manuf database due to {e}")
-                mac_parser = MacParser()
+            mac_parser = MacParser()
+            # Only download a new manuf database once the local copy is stale
+            manuf_file = MacParser.get_packaged_manuf_file_path()
+            manuf_age = time.time() - os.path.getmtime(manuf_file)
+            if manuf_age > MANUF_MAX_AGE:
+                verboseprint(f"Updating manuf database, {manuf_age / 3600:.0f} hours old")
+                try:
+                    mac_parser.update(manuf_url="https://www.wireshark.org/download/automated/data/manuf")
+                except Exception as e:
+                    verboseprint(f"Unable to update manuf database due to {e}")
+                    mac_parser = MacParser()
+            else:
+                verboseprint(f"Using cached manuf database, {manuf_age / 3600:.0f} hours old")
             self.parser = mac_parser
+            self._oui_masks = self._get_oui_masks()
+            # The same devices show up in many networks, so remember lookups
+            self._check_manuf = functools.lru_cache(maxsize=8192)(
+                self._is_bad_manuf
+            )
         # Load these from file once and use throughout
         self.bad_macs = self._get_bad_macs()
         self.bad_coms = self._get_bad_companies()
+        # Precompile the lists so each client is classified in a single pass
+        self._match_company = self._build_company_matcher()
+        self._mac_buckets = self._build_mac_buckets()
+        # Manufacturer names repeat across clients, so remember each verdict
+        self._check_manufacturer = functools.lru_cache(maxsize=1 << 15)(
+            self.is_bad_company
+        )
 
-    def _get_bad_macs(self) -> list:
+    def _get_bad_macs(self) -> frozenset:
         with open(self._mac_file) as mf:
-            bad_macs = mf.read().splitlines()
-        return bad_macs or None
+            # MACs are matched case-insensitively and without separators
+            lines = mf.read().lower().translate(MAC_SEPARATORS).splitlines()
+        return frozenset(bad_mac for bad_mac in map(str.strip, lines) if bad_mac)
 
-    def _get_bad_companies(self) -> list:
+    def _get_bad_companies(self) -> frozenset:
         with open(self._com_file) as cf:
-            bad_coms = cf.read().splitlines()
-        return bad_coms or None
+            # Companies are matched case-sensitively, exactly as written
+            lines = cf.read().splitlines()
+        return frozenset(bad_com for bad_com in map(str.strip, lines) if bad_com)
+
+    def _build_company_matcher(self) -> Union[Callable[[str], bool], None]:
+        if not self.bad_coms:
+            return None
+        if ahocorasick is None:
+            # Without pyahocorasick a single alternation still scans in C
+            pattern = re.compile('|'.join(map(re.escape, self.bad_coms)))
+            return lambda company: pattern.search(company) is not None
+        # Aho-Corasick finds any bad company substring in one walk of the name
+        automaton = ahocorasick.Automaton()
+        for bad_com in self.bad_coms:
+            automaton.add_word(bad_com, bad_com)
+        automaton.make_automaton()
+        return lambda company: next(automaton.iter(company), None) is not None
+
+    def _build_mac_buckets(self) -> dict:
+        # Group prefixes by length so a lookup is one slice + hash per length
+        buckets = {}
+        for bad_mac in self.bad_macs:
+            buckets.setdefault(len(bad_mac), set()).add(bad_mac)
+        return {length: frozenset(prefixes)
+                for length, prefixes in buckets.items()}
+
+    def _get_oui_masks(self) -> Union[list, None]:
+        # MacParser.search probes every mask width up to 48 bits, but the
+        # database only uses a handful, so remember those (most specific first).
+        # This relies on manuf's private (mask, prefix) -> Vendor table, so
+        # fall back to get_manuf if its layout is not the one expected
+        vendors = getattr(self.parser, '_masks', None)
+        if not isinstance(vendors, dict) or not vendors:
+            return None
+        samples = {}
+        for key, vendor in vendors.items():
+            if not (isinstance(key, tuple) and len(key) == 2
+                    and all(isinstance(part, int) for part in key)
+                    and 0 <= key[0] < 48 and hasattr(vendor, 'manuf')):
+                return None
+            samples.setdefault(key[0], key)
+        masks = sorted(samples)
+        # Check a MAC at each end of one block per mask width, and a few
+        # fixed ones, against manuf's own lookup
+        macs = ['00:00:00:00:00:00', 'ff:ff:ff:ff:ff:ff', '00:e0:fc:11:22:33']
+        for mask, prefix in samples.values():
+            first = (prefix << mask) & ((1 << 48) - 1)
+            for mac_int in (first, first | ((1 << mask) - 1)):
+                mac_hex = f"{mac_int:012x}"
+                macs.append(':'.join(mac_hex[i:i + 2] for i in range(0, 12, 2)))
+        for mac in macs:
+            if self._search_manuf(mac, masks) != self.parser.get_manuf(mac):
+                verboseprint("Unexpected manuf database layout, using get_manuf")
+                return None
+        return masks
+
+    def _search_manuf(self, mac: str, masks: list) -> Union[str, None]:
+        mac_str = mac.translate(MAC_SEPARATORS)
+        bits_left = 48 - 4 * len(mac_str)
+        try:
+            mac_int = int(mac_str, 16) << bits_left
+        except ValueError:
+            raise ValueError(f"Could not parse MAC: {mac_str}")
+        vendors = self.parser._masks
+        for mask in masks:
+            if mask >= bits_left:
+                vendor = vendors.get((mask, mac_int >> mask))
+                if vendor:
+                    return vendor.manuf
+        return None
+
+    def _get_manuf(self, mac: str) -> Union[str, None]:
+        if self._oui_masks is None:
+            return self.parser.get_manuf(mac)
+        return self._search_manuf(mac, self._oui_masks)
+
+    def _is_bad_manuf(self, mac: str) -> bool:
+        mac_com = self._get_manuf(mac)
+        return self.is_bad_company(mac_com)
 
     def is_bad_company(self, company: str) -> bool:
-        if self.bad_coms and company:
-            for bad_com in self.bad_coms:
-                if bad_com in company:
-                    return True
+        if self._match_company is not None and company:
+            return self._match_company(company)
         return False
 
     def is_bad_mac(self, mac: str) -> bool:
-        if self.bad_macs:
-            for bad_mac in self.bad_macs:
-                if mac.startswith(bad_mac):
-                    return True
-        if self._use_manuf:
-            mac_com = self.parser.get_manuf(mac)
-            return self.is_bad_company(mac_com)
+        mac_l = mac.lower().translate(MAC_SEPARATORS)
+        for length, prefixes in self._mac_buckets.items():
+            if mac_l[:length] in prefixes:
+                return True
+        # Only pay for a manuf lookup when there are companies to match
+        if self._use_manuf and self._match_company is not None:
+            return self._check_manuf(mac)
         return False
 
     def is_bad_client(self, client: dict) -> bool:
-        if self.is_bad_mac(client['mac']):
-            return True
-        if self.is_bad_company(client['manufacturer']):
+        # The manufacturer Meraki reports is cheaper to check than the manuf
+        # lookup in is_bad_mac, so try it first
+        if self._check_manufacturer(client['manufacturer']):
             return True
-        return False
+        return self.is_bad_mac(client['mac'])
 
 
 class FHI360:
@@ -139,7 +276,9 @@ class FHI360:
         error_msg = None
         try:
             resp = self.api.organizations.getOrganizationNetworks(
-                    self.org_id
+                    self.org_id,
+                    perPage=100000,
+                    total_pages='all',
                 )
         except meraki.APIError as e:
             error_msg = f"""
@@ -170,7 +309,7 @@ class FHI360:
             resp = self.api.networks.getNetworkClients(
                 network_id,
                 timespan=self.timespan,
-                perPage=1000,
+                perPage=CLIENTS_PER_PAGE,
                 total_pages='all',
             )
         except meraki.APIError as e:
@@ -225,44 +364,47 @@ class FHI360:
             return True, None
         return False, resp
 
-def purge(dir, pattern, days):
-    # number of seconds in a day 
-    day = 86400
-    current_time = time.time() 
-    regexObj = re.compile(pattern)
-    for root, dirs, files in os.walk(dir, topdown=False):
-        # iterate over the files in the current directory and remove old files
-        for name in files:
-            verboseprint(f"Checking file [{name}]")
-            path = os.path.join(root, name)
-            if bool(regexObj.search(name)):
-                # file_time is the time when the file was modified 
-                file_time = os.stat(path).st_mtime 
-            
-                # if a file is older than N days then delete it 
-                if(file_time < current_time - day*days): 
-                    verboseprint(f"removing file [{path}]")
-                    os.remove(path)
-        # iterate over the directories in the current directory and remove empty directories            
-        for name in dirs:
-            verboseprint(f"Checking folder [{name}]")
-            path = os.path.join(root, name)
-            if len(os.listdir(path)) == 0:
-                verboseprint(f"removing folder [{path}]")
-                os.rmdir(path)
+def format_usage(usage: Union[dict, None]) -> str:
+    # Meraki reports no usage for some clients
+    if not usage:
+        return ""
+    return f"sent={usage['sent']} recv={usage['recv']}"
+
+def purge(dir, suffix, days):
+    # files last modified before this time are removed
+    cutoff = time.time() - 86400 * days
+    with os.scandir(dir) as it:
+        entries = list(it)
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            # clean the folder out first, then remove it if nothing is left
+            verboseprint(f"Checking folder [{entry.name}]")
+            purge(entry.path, suffix, days)
+            with os.scandir(entry.path) as it:
+                is_empty = next(it, None) is None
+            if is_empty:
+                verboseprint(f"removing folder [{entry.path}]")
+                os.rmdir(entry.path)
+        elif entry.name.endswith(suffix):
+            verboseprint(f"Checking file [{entry.name}]")
+            # DirEntry reuses the scan data where it can and caches the stat
+            if entry.stat().st_mtime < cutoff:
+                verboseprint(f"removing file [{entry.path}]")
+                os.remove(entry.path)
 
 def main():
     tday = f"{datetime.now():%Y-%m-%d-%H%M}"
     log_file_prefix = "FHI-360"
     log_dir = os.path.join(HERE, "logs")
-    if "logs" not in os.listdir(HERE):
-        os.mkdir(log_dir)
+    os.makedirs(log_dir, exist_ok=True)
     # Instantiate a new ClientValidator with defaults
     validator = ClientValidator()
     # Instantiate a Meraki dashboard API session
     api = meraki.DashboardAPI(
         api_key=api_key,
         base_url=base_url,
+        # Sleep for the Retry-After the API sends with a 429 before retrying
+        wait_on_rate_limit=True,
         maximum_retries=4,
         output_log=True,
         log_file_prefix=log_file_prefix,
@@ -274,8 +416,7 @@ def main():
     verboseprint(f"\nAnalyzing organization {fhi.org_name}:")
     folder_name = f"FHI-360_clients_{tday}"
     folder_dir = os.path.join(HERE, folder_name)
-    if folder_name not in os.listdir(HERE):
-        os.mkdir(folder_dir)
+    os.makedirs(folder_dir, exist_ok=True)
     msg = EmailMessage()
     msg['Subject'] = 'Meraki Bad client Report'
     msg['From'] = EmailFrom
@@ -285,81 +426,97 @@ def main():
         total = len(networks)
         counter = 1
         verboseprint(f"Found {total} networks in organization {fhi.org_name}")
-        for net in networks:
-            verboseprint(f"Searching clients in network {net['name']} ({counter} of {total})")
-            success, clients = fhi.get_clients(net['id'])
-            if success:
-                bad_clients = [client for client in clients if \
-                                validator.is_bad_client(client)]
-                if bad_clients:
-                    verboseprint(f"Found {len(bad_clients)} bad clients total")
-                    for client in bad_clients:
-                        # Reformat usage for readability
-                        sent_usage = client['usage']['sent']
-                        recv_usage = client['usage']['recv']
-                        client['usage'] = f"sent={sent_usage} recv={recv_usage}"
-                        client['blocked'] = 'Unknown'
-                        if BLOCK_BAD_CLIENTS:
-                            verboseprint(f"Now trying to block bad client: {client['id']}")
-                            success, error_msg = fhi.block_client(
-                                net['id'],
-                                client['id'],
-                                catch_errors=CATCH_ERRORS,
-                            )
-                            if success:
-                                client['blocked'] = True
-                                verboseprint(f"Successfully blocked: {client['id']}")
-                            else:
-                                client['blocked'] = 'Failed'
-                                verboseprint(f"FAILED to block: {client['id']}\n\n{error_msg}")
-                    file_name = f"{net['name'].replace(' ', '')}.csv"
-                    output_file = open(f"{folder_dir}/{file_name}",
-                                        mode='w', newline='\n')
-                    field_names = bad_clients[0].keys()
-                    csv_writer = csv.DictWriter(output_file, field_names,
-                                                delimiter=',', quotechar='"',
-                                                quoting=csv.QUOTE_ALL)
-                    csv_writer.writeheader()
-                    csv_writer.writerows(bad_clients)
-                    output_file.close()
-            else:
-                verboseprint(f"get_clients failed for network {net['id']}\n\n{clients}")
-            counter += 1
-        # Stitch together one consolidated CSV report of all bad clients
+        # Write each network's bad clients straight into one consolidated report
         total_file = os.path.join(HERE, f"{folder_name}.csv")
-        output_file = open(total_file, mode='w', newline='\n')
-        field_names = ['id', 'mac', 'description', 'ip', 'ip6', 'ip6Local', 'user',
-                    'firstSeen', 'lastSeen', 'manufacturer', 'os',
-                    'recentDeviceSerial', 'recentDeviceName', 'recentDeviceMac', 'recentDeviceConnection',
-                    'ssid', 'vlan', 'switchport', 'usage', 'status', 'notes', 'pskGroup', 'namedVlan',
-                    'smInstalled', 'groupPolicy8021x', 'adaptivePolicyGroup', 'blocked', 'deviceTypePrediction', 'wirelessCapabilities']
-        field_names.insert(0, "Network Name")
-        field_names.insert(1, "Network ID")
-        csv_writer = csv.DictWriter(output_file, field_names, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-        csv_writer.writeheader()
-        for net in networks:
-            file_name = f"{net['name'].replace(' ', '')}.csv"
-            if file_name in os.listdir(folder_dir):
-                with open(f"{folder_dir}/{file_name}") as input_file:
-                    csv_reader = csv.DictReader(input_file, delimiter=',', quotechar='"', quoting=csv.QUOTE_ALL)
-                    for row in csv_reader:
-                        row['Network Name'] = net['name']
-                        row['Network ID'] = net['id']
-                        csv_writer.writerow(row)
-        os.fsync(output_file)
-        output_file.close()
+        total_output = open(total_file, mode='w', newline='\n',
+                            buffering=CSV_BUFFER_SIZE)
+        total_writer = csv.writer(total_output, delimiter=',', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        total_writer.writerow(('Network Name', 'Network ID', *CLIENT_FIELD_NAMES))
+        # Fetch clients for several networks at once, but handle them in order.
+        # Only a bounded window of fetches is queued, so at most that many
+        # networks' client lists are held in memory at any time
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            queued = iter(networks)
+            pending = deque(
+                (net, pool.submit(fhi.get_clients, net['id']))
+                for net in itertools.islice(queued, 2 * MAX_WORKERS)
+            )
+            try:
+                while pending:
+                    net, future = pending.popleft()
+                    success, clients = future.result()
+                    next_net = next(queued, None)
+                    if next_net is not None:
+                        pending.append(
+                            (next_net, pool.submit(fhi.get_clients, next_net['id']))
+                        )
+                    verboseprint(f"Searching clients in network {net['name']} ({counter} of {total})")
+                    if success:
+                        bad_clients = [client for client in clients if \
+                                        validator.is_bad_client(client)]
+                        if bad_clients:
+                            verboseprint(f"Found {len(bad_clients)} bad clients total")
+                            for client in bad_clients:
+                                # Reformat usage for readability
+                                client['usage'] = format_usage(client['usage'])
+                                client['blocked'] = 'Unknown'
+                                if BLOCK_BAD_CLIENTS:
+                                    verboseprint(f"Now trying to block bad client: {client['id']}")
+                                    success, error_msg = fhi.block_client(
+                                        net['id'],
+                                        client['id'],
+                                        catch_errors=CATCH_ERRORS,
+                                    )
+                                    if success:
+                                        client['blocked'] = True
+                                        verboseprint(f"Successfully blocked: {client['id']}")
+                                    else:
+                                        client['blocked'] = 'Failed'
+                                        verboseprint(f"FAILED to block: {client['id']}\n\n{error_msg}")
+                            if WRITE_NETWORK_REPORTS:
+                                file_name = f"{net['name'].replace(' ', '')}.csv"
+                                field_names = tuple(bad_clients[0].keys())
+                                with open(f"{folder_dir}/{file_name}", mode='w',
+                                          newline='\n',
+                                          buffering=CSV_BUFFER_SIZE) as output_file:
+                                    csv_writer = csv.writer(output_file,
+                                                            delimiter=',', quotechar='"',
+                                                            quoting=csv.QUOTE_MINIMAL)
+                                    csv_writer.writerow(field_names)
+                                    csv_writer.writerows(
+                                        map(client.get, field_names)
+                                        for client in bad_clients
+                                    )
+                            # Project each client onto the report columns in one pass
+                            total_writer.writerows(
+                                [net['name'], net['id'], *map(client.get, CLIENT_FIELD_NAMES)]
+                                for client in bad_clients
+                            )
+                    else:
+                        verboseprint(f"get_clients failed for network {net['id']}\n\n{clients}")
+                    counter += 1
+            finally:
+                # Don't wait on queued fetches if handling a network failed
+                for _, future in pending:
+                    future.cancel()
+        total_output.flush()
+        os.fsync(total_output)
+        total_output.close()
         msg.set_content('Report attached')
-        with open(total_file, 'rb') as content_file:
-            content = content_file.read()
-            msg.add_attachment(content, maintype='application', subtype='octet-stream', filename=f"{folder_name}.csv")
+        # Compress while reading so the raw report is never held in memory
+        content = io.BytesIO()
+        with open(total_file, 'rb') as content_file, \
+                gzip.GzipFile(fileobj=content, mode='wb', mtime=0) as gz_file:
+            shutil.copyfileobj(content_file, gz_file)
+        msg.add_attachment(content.getvalue(), maintype='application', subtype='gzip', filename=f"{folder_name}.csv.gz")
     else:
         verboseprint(f"get_networks failed \n\n{networks}")
         msg.set_content('No Networks found')
     verboseprint(f"\nsending report for {fhi.org_name} from {sender_name} [{sender_prefix}@{sender_suffix}] to {rcpt_name} [{rcpt_prefix}@{rcpt_suffix}]")
     s = smtplib.SMTP(SMTPSRV)
     s.send_message(msg)
-    purge(HERE, r".*\.csv", 30)
-    purge(HERE, r".*\.log", 30)
+    purge(HERE, ".csv", 30)
+    purge(HERE, ".log", 30)
     s.quit()
 
 